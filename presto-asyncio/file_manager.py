@@ -1,42 +1,60 @@
+import asyncio
 import json
 import os
+from contextlib import asynccontextmanager
+from datetime import date, datetime, time
 
-from aiofile import async_open
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+WRITE_BUFSIZE = 1 << 20
 
-async def save_columns_to_csv_file(columns, query_id):
-    if os.path.isfile(query_id + '.csv'):
-        return
 
-    data = {
-        'columns': []
-    }
-    for column in columns:
-        data['columns'].append({
-            'name': column['name'],
-            'type': column['type']
-        })
-    async with async_open(query_id + '.csv', 'w+') as afp:
-        await afp.write(json.dumps(data))
+def _default(value):
+    # the types neither encoder writes natively; the stdlib one also needs the temporal ones
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+# Rows reach these already normalised by the row converters in main: doubles are kept as the
+# JSON Presto sent (so 'Infinity' and 'NaN' stay strings), times with a time zone and
+# converted map keys are ISO strings. Everything else is encoded natively by orjson, which
+# matches what _default gives the stdlib encoder byte for byte.
+def _dumps_orjson(obj):
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_APPEND_NEWLINE)
+
 
+def _dumps_json(obj):
+    data = json.dumps(obj, default=_default, separators=(',', ':'), ensure_ascii=False, allow_nan=False)
+    return (data + '\n').encode('utf-8')
 
-async def save_rows_to_csv_file(rows, query_id):
-    async with async_open(query_id + '.csv', 'r') as afp:
-        data = json.loads(await afp.read())
 
-    if 'rows' not in data:
-        data['rows'] = rows
-    else:
-        data['rows'].append(rows)
+if orjson is not None:
+    _dumps = _dumps_orjson
+    _loads = orjson.loads
+else:
+    _dumps = _dumps_json
+    _loads = json.loads
 
-    async with async_open(query_id + '.csv', 'w+') as afp:
-        await afp.write(json.dumps(data))
 
+def _write_header(path, data):
+    # 'x' makes the existence check and the create one step, so only one writer owns the header
+    try:
+        with open(path, 'xb') as fp:
+            fp.write(_dumps(data))
+    except FileExistsError:
+        pass
 
-async def save_columns_to_json_file(columns, query_id):
-    if os.path.isfile(query_id + '.json'):
-        return
 
+def _write_rows(path, rows):
+    with open(path, 'ab', buffering=WRITE_BUFSIZE) as fp:
+        write_rows(fp, rows)
+
+
+async def save_columns(columns, query_id, ext='json'):
     data = {
         'columns': []
     }
@@ -45,18 +63,60 @@ async def save_columns_to_json_file(columns, query_id):
             'name': column['name'],
             'type': column['type']
         })
-    async with async_open(query_id + '.json', 'w+') as afp:
-        await afp.write(json.dumps(data))
+    await asyncio.to_thread(_write_header, query_id + '.' + ext, data)
+
+
+async def save_rows(rows, query_id, ext='json'):
+    await asyncio.to_thread(_write_rows, query_id + '.' + ext, rows)
+
+
+@asynccontextmanager
+async def open_rows_file(query_id, ext='json'):
+    fp = await asyncio.to_thread(open, query_id + '.' + ext, 'ab', buffering=WRITE_BUFSIZE)
+    try:
+        yield fp
+    finally:
+        await asyncio.to_thread(fp.close)
+
+
+def dump_rows(rows):
+    return b''.join(map(_dumps, rows))
+
+
+if hasattr(os, 'writev'):
+    try:
+        IOV_MAX = os.sysconf('SC_IOV_MAX')
+    except (ValueError, OSError):
+        IOV_MAX = 1024
+    # sysconf returns -1 when the limit is indeterminate, which would make every slice empty
+    if IOV_MAX <= 0:
+        IOV_MAX = 1024
+
+    def write_batches(fp, batches):
+        # submit all pending batches with one writev call instead of joining them first
+        fp.flush()
+        fd = fp.fileno()
+        batches = list(batches)
+        start = 0
+        while start < len(batches):
+            written = os.writev(fd, batches[start:start + IOV_MAX])
+            while start < len(batches) and written >= len(batches[start]):
+                written -= len(batches[start])
+                start += 1
+            if written:
+                batches[start] = memoryview(batches[start])[written:]
+else:
+    def write_batches(fp, batches):
+        fp.write(b''.join(batches))
 
 
-async def save_rows_to_json_file(rows, query_id):
-    async with async_open(query_id + '.json', 'r') as afp:
-        data = json.loads(await afp.read())
+def write_rows(fp, rows):
+    for row in rows:
+        fp.write(_dumps(row))
 
-    if 'rows' not in data:
-        data['rows'] = rows
-    else:
-        data['rows'].append(rows)
 
-    async with async_open(query_id + '.json', 'w+') as afp:
-        await afp.write(json.dumps(data))
+def read_rows(path):
+    with open(path, 'rb') as fp:
+        fp.readline()  # skip columns header
+        for line in fp:
+            yield _loads(line)
@@ -1,16 +1,17 @@
 import asyncio
 import logging
 import re
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, time, timedelta, timezone
 from decimal import Decimal
-from typing import Tuple, Any, Dict
+from functools import lru_cache
+from typing import Tuple, Any, Dict, Callable, Optional, List
+from zoneinfo import ZoneInfo
 
-import pytz
 from prestodb.exceptions import HttpError
 
-from file_manager import save_columns_to_csv_file, save_rows_to_csv_file
+from file_manager import save_columns, open_rows_file, dump_rows, write_batches
 from presto.presto_query import PrestoQuery
-from presto.presto_request import PrestoRequest
+from presto.presto_request import PrestoRequest, PrestoSessionPool
 from query_context import QueryContext
 
 logger = logging.getLogger(__name__)
@@ -19,8 +20,28 @@ INF = float("inf")
 NEGATIVE_INF = float("-inf")
 NAN = float("nan")
 
+_TZ_RE = re.compile(r'^(.*)([+\-])(\d{2}):(\d{2})$')
+
+# longest values with at most microsecond precision: 'YYYY-MM-DD HH:MM:SS.ffffff' and 'HH:MM:SS.ffffff'
+_MAX_TIMESTAMP_LEN = 26
+_MAX_TIME_LEN = 15
+_OFFSET_LEN = len('+00:00')
+
+WRITE_BUFFER_SIZE = 256 * 1024
+CONVERT_IN_THREAD_ROWS = 1000
+
+
+async def execute_presto(
+        query_context: QueryContext,
+        request: Optional[PrestoRequest] = None,
+        session_pool: Optional[PrestoSessionPool] = None,
+):
+    if request is not None:
+        # the caller owns the request (and its HTTP session) and keeps it open across queries
+        _check_request(request, query_context)
+        request.next_uri = query_context.next_uri
+        return await _run_query(request, query_context)
 
-async def execute_presto(query_context: QueryContext):
     request = PrestoRequest(
         host=query_context.host,
         port=query_context.port,
@@ -29,114 +50,282 @@ async def execute_presto(query_context: QueryContext):
         schema=query_context.schema,
         source=query_context.source,
         next_uri=query_context.next_uri,
+        session_pool=session_pool,
     )
     async with request as req:
-        query = PrestoQuery(req, sql=query_context.query)
+        return await _run_query(req, query_context)
 
-        try:
-            rows = []
-            columns = []
-
-            await query.execute()
-            if query.result:
-                rows.extend(query.result)
-            if query.columns:
-                columns = query.columns
-
-            while not query.is_finished():
-                results = await query.fetch()
-                if not columns and query.columns:
-                    columns = query.columns
-                    await save_columns_to_csv_file(query.query_id)
-
-                if results:
-                    convert_results = []
-                    for row in results:
-                        convert_results.append(list(map(map_to_python_type, zip(row, columns))))
-                    rows.extend(convert_results)
-                    await save_rows_to_csv_file(query.query_id)
-
-            logger.info(f"row size:{len(rows)}")
-            logger.info(f"columns:{columns}")
-            logger.info(f"query_id:{query.query_id}")
-            return query_context
-        except HttpError as err:
-            logger.exception("HttpError")
-        except BaseException:
-            logger.exception("Unknown Exception")
-        finally:
-            return query_context
+
+def _check_request(request: PrestoRequest, query_context: QueryContext):
+    # a caller-owned request keeps the coordinator and session it was built with, so a query
+    # context aimed elsewhere is rejected instead of silently running against the request's settings
+    client_session = request.client_session
+    mismatched = [
+        name for name, expected, actual in (
+            ("host", query_context.host, request.host),
+            ("port", query_context.port, request.port),
+            ("user", query_context.user, client_session.user),
+            ("catalog", query_context.catalog, client_session.catalog),
+            ("schema", query_context.schema, client_session.schema),
+            ("source", query_context.source, client_session.source),
+        )
+        if expected != actual
+    ]
+    if mismatched:
+        raise ValueError("query context does not match the request: {}".format(", ".join(mismatched)))
+
+
+async def execute_presto_batch(query_contexts: List[QueryContext], max_concurrency: int = 8):
+    # Presto runs one statement per submission, so queued queries are submitted side by side
+    # over the pooled connections instead of being merged into a single statement.
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(query_context):
+        async with semaphore:
+            return await execute_presto(query_context, session_pool=session_pool)
+
+    async with PrestoSessionPool() as session_pool:
+        return await asyncio.gather(*(run(query_context) for query_context in query_contexts), return_exceptions=True)
+
+
+async def _run_query(req: PrestoRequest, query_context: QueryContext):
+    query = PrestoQuery(req, sql=query_context.query)
+
+    try:
+        row_count = 0
+
+        results = await query.execute()
+        while not query.columns and not query.is_finished():
+            results = await query.fetch()
+        columns = query.columns or []
+        converters = _make_row_converters(columns)
+        await save_columns(columns, query.query_id, ext='csv')
+
+        async with open_rows_file(query.query_id, ext='csv') as afp:
+            pending = []
+            pending_bytes = 0
+            pending_write = None
+            fetching = None
+            try:
+                while True:
+                    # the next page is fetched while this one is converted and the previous flush is written
+                    fetching = None if query.is_finished() else asyncio.create_task(query.fetch())
+                    if results:
+                        if len(results) >= CONVERT_IN_THREAD_ROWS:
+                            payload = await asyncio.to_thread(_convert_batch, results, converters)
+                        else:
+                            payload = _convert_batch(results, converters)
+                        row_count += len(results)
+                        pending.append(payload)
+                        pending_bytes += len(payload)
+                        if pending_bytes > WRITE_BUFFER_SIZE:
+                            if pending_write:
+                                await pending_write
+                            pending_write = asyncio.create_task(asyncio.to_thread(write_batches, afp, pending))
+                            pending = []
+                            pending_bytes = 0
+                    if fetching is None:
+                        break
+                    results = await fetching
+                if pending:
+                    if pending_write:
+                        await pending_write
+                    pending_write = asyncio.create_task(asyncio.to_thread(write_batches, afp, pending))
+            finally:
+                if fetching is not None and not fetching.done():
+                    fetching.cancel()
+                if pending_write:
+                    await pending_write
+
+        logger.info("row size:%d", row_count)
+        logger.info("columns:%d", len(columns))
+        logger.info("query_id:%s", query.query_id)
+        return query_context
+    except HttpError:
+        logger.exception("HttpError")
+        raise
+    except Exception:
+        logger.exception("Unknown Exception")
+        raise
+
+
+def _make_row_converters(columns):
+    converters = ((index, _make_converter(column, for_file=True)) for index, column in enumerate(columns))
+    return [(index, convert) for index, convert in converters if convert is not _identity]
+
+
+def _convert_rows(rows, converters):
+    # rows are freshly decoded lists, so only the columns that need a conversion are replaced in place
+    if converters:
+        for row in rows:
+            for index, convert in converters:
+                row[index] = convert(row[index])
+    return rows
+
+
+def _convert_batch(rows, converters):
+    return dump_rows(_convert_rows(rows, converters))
 
 
 def map_to_python_type(item: Tuple[Any, Dict]) -> Any:
     (value, data_type) = item
+    return _make_converter(data_type)(value)
+
+
+def _make_converter(data_type: Dict, for_file: bool = False) -> Callable[[Any], Any]:
+    # for_file converters produce what the result file stores rather than python objects: doubles
+    # keep the JSON Presto sent ('Infinity' and 'NaN' as strings), times with a time zone and
+    # converted map keys become ISO strings, and containers of pass-through items are passed through
+    type_signature = data_type["typeSignature"]
+    raw_type = type_signature["rawType"]
 
-    if value is None:
-        return None
+    if raw_type == "array":
+        item_converter = _make_converter({"typeSignature": type_signature["arguments"][0]["value"]}, for_file)
+        if for_file and item_converter is _identity:
+            return _identity
 
-    raw_type = data_type["typeSignature"]["rawType"]
+        def convert(value):
+            return [item_converter(array_item) for array_item in value]
+    elif raw_type == "row":
+        item_converters = [_make_converter(arg["value"], for_file) for arg in type_signature["arguments"]]
+        if for_file and all(item_converter is _identity for item_converter in item_converters):
+            return _identity
 
+        def convert(value):
+            return tuple(
+                item_converter(array_item)
+                for (item_converter, array_item) in zip(item_converters, value)
+            )
+    elif raw_type == "map":
+        key_converter = _make_converter({"typeSignature": type_signature["arguments"][0]["value"]}, for_file)
+        value_converter = _make_converter({"typeSignature": type_signature["arguments"][1]["value"]}, for_file)
+        if for_file:
+            if key_converter is _identity and value_converter is _identity:
+                return _identity
+            if key_converter is not _identity:
+                key_converter = _compose(_to_key, key_converter)
+
+        def convert(value):
+            return {key_converter(key): value_converter(value[key]) for key in value}
+    elif "decimal" in raw_type:
+        convert = Decimal
+    elif raw_type == "double":
+        if for_file:
+            return _identity
+        convert = _to_double
+    elif raw_type == "date":
+        convert = _to_date
+    elif raw_type == "timestamp with time zone":
+        convert = _to_timestamp_with_time_zone
+    elif "timestamp" in raw_type:
+        convert = _to_timestamp
+    elif "time with time zone" in raw_type:
+        convert = _to_time_with_time_zone
+        if for_file:
+            convert = _compose(time.isoformat, convert)
+    elif "time" in raw_type:
+        convert = _to_time
+    else:
+        return _identity
+
+    def converter(value):
+        if value is None:
+            return None
+        try:
+            return convert(value)
+        except ValueError as e:
+            error_str = f"Could not convert '{value}' into the associated python type for '{raw_type}'"
+            raise TypeError(error_str) from e
+
+    return converter
+
+
+def _identity(value):
+    return value
+
+
+def _compose(outer, inner):
+    def composed(value):
+        return outer(inner(value))
+
+    return composed
+
+
+def _to_key(value):
+    # JSON object keys are strings; temporal keys are written the way temporal values are
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _to_double(value):
+    if value == 'Infinity':
+        return INF
+    elif value == '-Infinity':
+        return NEGATIVE_INF
+    elif value == 'NaN':
+        return NAN
+    return value
+
+
+def _to_date(value):
     try:
-        if isinstance(value, list):
-            if raw_type == "array":
-                raw_type = {
-                    "typeSignature": data_type["typeSignature"]["arguments"][0]["value"]
-                }
-                return [map_to_python_type((array_item, raw_type)) for array_item in value]
-            if raw_type == "row":
-                raw_types = map(lambda arg: arg["value"], data_type["typeSignature"]["arguments"])
-                return tuple(
-                    map_to_python_type((array_item, raw_type))
-                    for (array_item, raw_type) in zip(value, raw_types)
-                )
-            return value
-        if isinstance(value, dict):
-            raw_key_type = {
-                "typeSignature": data_type["typeSignature"]["arguments"][0]["value"]
-            }
-            raw_value_type = {
-                "typeSignature": data_type["typeSignature"]["arguments"][1]["value"]
-            }
-            return {
-                map_to_python_type((key, raw_key_type)):
-                    map_to_python_type((value[key], raw_value_type))
-                for key in value
-            }
-        elif "decimal" in raw_type:
-            return Decimal(value)
-        elif raw_type == "double":
-            if value == 'Infinity':
-                return INF
-            elif value == '-Infinity':
-                return NEGATIVE_INF
-            elif value == 'NaN':
-                return NAN
-            return value
-        elif raw_type == "date":
-            return datetime.strptime(value, "%Y-%m-%d").date()
-        elif raw_type == "timestamp with time zone":
-            dt, tz = value.rsplit(' ', 1)
-            if tz.startswith('+') or tz.startswith('-'):
-                return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f %z")
-            return datetime.strptime(dt, "%Y-%m-%d %H:%M:%S.%f").replace(tzinfo=pytz.timezone(tz))
-        elif "timestamp" in raw_type:
-            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
-        elif "time with time zone" in raw_type:
-            matches = re.match(r'^(.*)([\+\-])(\d{2}):(\d{2})$', value)
-            assert matches is not None
-            assert len(matches.groups()) == 4
-            if matches.group(2) == '-':
-                tz = -timedelta(hours=int(matches.group(3)), minutes=int(matches.group(4)))
-            else:
-                tz = timedelta(hours=int(matches.group(3)), minutes=int(matches.group(4)))
-            return datetime.strptime(matches.group(1), "%H:%M:%S.%f").time().replace(tzinfo=timezone(tz))
-        elif "time" in raw_type:
-            return datetime.strptime(value, "%H:%M:%S.%f").time()
-        else:
-            return value
-    except ValueError as e:
-        error_str = f"Could not convert '{value}' into the associated python type for '{raw_type}'"
-        raise TypeError(error_str) from e
+        return date.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _parse_datetime(value, fmt, offset=''):
+    # fromisoformat is a C fast path; strptime still covers the shapes it rejects. From Python 3.11
+    # fromisoformat truncates fractions finer than a microsecond (timestamp(7) to timestamp(12)),
+    # so longer values skip it and strptime rejects them on every version, as 3.10 does
+    if len(value) <= _MAX_TIMESTAMP_LEN:
+        try:
+            return datetime.fromisoformat(value + offset)
+        except ValueError:
+            pass
+    return datetime.strptime(value + offset, fmt)
+
+
+@lru_cache(maxsize=64)
+def _tz(name):
+    return ZoneInfo(name)
+
+
+def _to_timestamp_with_time_zone(value):
+    dt, tz = value.rsplit(' ', 1)
+    if tz.startswith('+') or tz.startswith('-'):
+        return _parse_datetime(dt, "%Y-%m-%d %H:%M:%S.%f%z", tz)
+    return _parse_datetime(dt, "%Y-%m-%d %H:%M:%S.%f").replace(tzinfo=_tz(tz))
+
+
+def _to_timestamp(value):
+    return _parse_datetime(value, "%Y-%m-%d %H:%M:%S.%f")
+
+
+def _to_time_with_time_zone(value):
+    if len(value) <= _MAX_TIME_LEN + _OFFSET_LEN:
+        try:
+            return time.fromisoformat(value)
+        except ValueError:
+            pass
+    matches = _TZ_RE.match(value)
+    assert matches is not None
+    assert len(matches.groups()) == 4
+    if matches.group(2) == '-':
+        tz = -timedelta(hours=int(matches.group(3)), minutes=int(matches.group(4)))
+    else:
+        tz = timedelta(hours=int(matches.group(3)), minutes=int(matches.group(4)))
+    return datetime.strptime(matches.group(1), "%H:%M:%S.%f").time().replace(tzinfo=timezone(tz))
+
+
+def _to_time(value):
+    if len(value) <= _MAX_TIME_LEN:
+        try:
+            return time.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.strptime(value, "%H:%M:%S.%f").time()
 
 
 if __name__ == "__main__":
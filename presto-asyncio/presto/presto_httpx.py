@@ -0,0 +1,100 @@
+class HttpxResponse(object):
+    """Expose an ``httpx.Response`` through the subset of ``aiohttp.ClientResponse`` used by PrestoRequest."""
+
+    def __init__(self, response):
+        self._response = response
+
+    @property
+    def status(self):
+        # type: () -> int
+        return self._response.status_code
+
+    @property
+    def ok(self):
+        # type: () -> bool
+        return self._response.status_code < 400
+
+    @property
+    def headers(self):
+        return self._response.headers
+
+    @property
+    def content(self):
+        # type: () -> bytes
+        return self._response.content
+
+    def release(self):
+        # the body is already read and the connection returned to the pool
+        pass
+
+    async def read(self):
+        # type: () -> bytes
+        # non-streaming httpx requests have already read the body
+        return self._response.content
+
+
+class HttpxSession(object):
+    """
+    HTTP/2 ``httpx.AsyncClient`` behind the ``get``/``post``/``delete`` calls
+    PrestoRequest makes on an ``aiohttp.ClientSession``.
+
+    HTTP/2 lets concurrent ``next_uri`` polls share one TCP+TLS connection
+    as separate streams. Proxies are configured on the client, so the
+    per-request ``proxy`` argument is ignored.
+    """
+
+    def __init__(self, verify=False, http2=True):
+        # type: (bool, bool) -> None
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError("unable to import httpx")
+
+        self._httpx = httpx
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            verify=verify,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+        )
+
+    @property
+    def headers(self):
+        return self._client.headers
+
+    @property
+    def closed(self):
+        # type: () -> bool
+        return self._client.is_closed
+
+    @property
+    def exceptions(self):
+        return (self._httpx.TransportError,)
+
+    async def close(self):
+        await self._client.aclose()
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return self._httpx.USE_CLIENT_DEFAULT
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self._httpx.Timeout(read, connect=connect)
+        return timeout
+
+    async def get(self, url, headers=None, timeout=None, proxy=None):
+        response = await self._client.get(url, headers=headers, timeout=self._timeout(timeout))
+        return HttpxResponse(response)
+
+    async def post(self, url, data=None, headers=None, timeout=None, allow_redirects=True, proxy=None):
+        response = await self._client.post(
+            url,
+            content=data,
+            headers=headers,
+            timeout=self._timeout(timeout),
+            follow_redirects=allow_redirects,
+        )
+        return HttpxResponse(response)
+
+    async def delete(self, url, headers=None, timeout=None, proxy=None):
+        response = await self._client.delete(url, headers=headers, timeout=self._timeout(timeout))
+        return HttpxResponse(response)
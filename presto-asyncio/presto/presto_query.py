@@ -57,8 +57,7 @@ class PrestoQuery(object):
         if self._cancelled:
             raise exceptions.PrestoUserError("Query has been cancelled", self.query_id)
 
-        if self.credentials is not None and not self.credentials.valid:
-            self._request.http_session.headers.update(self._request.get_oauth_token())
+        await self._request.refresh_oauth_token()
 
         if self._request.next_uri:
             response = await self._request.get(self._request.next_uri)
@@ -81,6 +80,7 @@ class PrestoQuery(object):
         # type: () -> List[List[Any]]
         """Continue fetching data for the current query_id"""
         logger.info(self._request.next_uri)
+        await self._request.refresh_oauth_token()
         response = await self._request.get(self._request.next_uri)
         status = await self._request.process(response)
         if status.columns:
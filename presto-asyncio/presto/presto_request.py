@@ -1,10 +1,14 @@
+import asyncio
 import functools
+import json
 import logging
+import time
+from datetime import timezone
 from typing import Any, Dict, List, Optional, Text, Tuple, Union  # NOQA for mypy types
+from urllib.parse import quote_from_bytes
 
 import aiohttp
 import prestodb
-import six.moves.urllib_parse as parse
 from aiohttp import ClientPayloadError
 from aiohttp.client_proto import ResponseHandler
 from aiohttp.helpers import BaseTimerContext
@@ -14,8 +18,26 @@ from prestodb.client import MAX_ATTEMPTS, ClientSession, PROXIES, get_header_val
     PrestoStatus
 from prestodb.transaction import NO_TRANSACTION
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+_RESERVED_HEADERS = frozenset((
+    constants.HEADER_CATALOG,
+    constants.HEADER_SCHEMA,
+    constants.HEADER_SOURCE,
+    constants.HEADER_USER,
+    constants.HEADER_SESSION,
+))
+
+_ERROR_CLASSES = {
+    "EXTERNAL": exceptions.PrestoExternalError,
+    "USER_ERROR": exceptions.PrestoUserError,
+}
 
 def is_redirect(http_response):
     # type: (aiohttp.ClientResponse) -> bool
@@ -25,8 +47,10 @@ def is_redirect(http_response):
 # Set allowed header size to 1MB - https://github.com/trinodb/trino/issues/8797
 # https://github.com/aio-libs/aiohttp/issues/2988
 class PrestoResponseHandler(ResponseHandler):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, read_bufsize=None, **kwargs):
         super().__init__(*args, **kwargs)
+        # statement pages can be multi-MB JSON; a bigger buffer means fewer parser wake-ups per page
+        self._preferred_bufsize = read_bufsize  # type: Optional[int]
 
     def set_response_params(
         self,
@@ -39,6 +63,8 @@ class PrestoResponseHandler(ResponseHandler):
         read_bufsize: int = 2 ** 16,
     ) -> None:
         self._skip_payload = skip_payload
+        if self._preferred_bufsize is not None:
+            read_bufsize = self._preferred_bufsize
 
         self._read_timeout = read_timeout
         self._reschedule_timeout()
@@ -63,13 +89,144 @@ class PrestoResponseHandler(ResponseHandler):
 
 
 class PrestoTCPConnector(aiohttp.TCPConnector):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """
+    TCP connector tuned for polling a Presto coordinator.
+
+    aiohttp caps a connector at 100 connections and drops idle keep-alive
+    sockets after 15s, which throttles many concurrent ``next_uri`` polls and
+    forces new TLS handshakes between pages. Here the connection limits are
+    off by default, idle sockets are kept for 60s and DNS answers are cached
+    for 300s. Responses are read with a 4 MiB buffer (``read_bufsize``)
+    instead of aiohttp's 64 KiB. A longer keepalive means a socket may
+    outlive a coordinator restart or load balancer change; lower
+    ``keepalive_timeout`` (or pass ``force_close=True``) when connections
+    must be recycled more eagerly.
+    """
 
-        self._factory = functools.partial(PrestoResponseHandler, loop=self._loop)
+    def __init__(
+            self,
+            *args,
+            limit=0,  # type: int
+            limit_per_host=0,  # type: int
+            keepalive_timeout=60,  # type: float
+            ttl_dns_cache=300,  # type: Optional[int]
+            enable_cleanup_closed=True,  # type: bool
+            force_close=False,  # type: bool
+            read_bufsize=4 * 1024 * 1024,  # type: int
+            **kwargs
+    ):
+        super().__init__(
+            *args,
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=ttl_dns_cache,
+            enable_cleanup_closed=enable_cleanup_closed,
+            force_close=force_close,
+            **kwargs
+        )
+
+        self._factory = functools.partial(PrestoResponseHandler, loop=self._loop, read_bufsize=read_bufsize)
 # End header size fix
 
 
+# Per-process caches for work that only depends on the auth class and retry settings,
+# so building a PrestoRequest per query doesn't redo it. Auth classes are few; retry
+# handlers can be created per request, so their cache is bounded.
+_EXC_CACHE = {}  # type: Dict[type, Tuple[type, ...]]
+
+
+def _auth_exceptions(auth):
+    # type: (Any) -> Tuple[type, ...]
+    auth_class = type(auth)
+    if auth_class not in _EXC_CACHE:
+        _EXC_CACHE[auth_class] = tuple(auth.get_exceptions())
+    return _EXC_CACHE[auth_class]
+
+
+def _is_503(response):
+    # need retry when there is no exception but the status code is 503
+    return getattr(response, "status", None) == 503
+
+
+@functools.lru_cache(maxsize=32)
+def _retry_decorator(handle_retry, retry_exceptions, max_attempts):
+    # type: (Any, Tuple[type, ...], int) -> Any
+    return exceptions.retry_with(
+        handle_retry,
+        exceptions=retry_exceptions,
+        conditions=(_is_503,),
+        max_attempts=max_attempts,
+    )
+
+
+TRANSPORT_AIOHTTP = "aiohttp"
+TRANSPORT_HTTPX = "httpx"
+
+
+def _new_session(transport, verify):
+    # type: (Text, bool) -> Any
+    if transport == TRANSPORT_HTTPX:
+        from presto.presto_httpx import HttpxSession
+
+        return HttpxSession(verify=verify)
+    return aiohttp.ClientSession(connector=PrestoTCPConnector(verify_ssl=verify))
+
+
+class PrestoSessionPool(object):
+    """
+    HTTP sessions shared by the PrestoRequest instances given this pool.
+
+    aiohttp sessions are keyed by (host, port, http_scheme, verify); one HTTP/2
+    httpx client multiplexes every coordinator, so it is only keyed by verify.
+    Sessions are bound to the event loop that opened them, so a pool is used
+    within one loop and closed before it ends, for example with
+    ``async with PrestoSessionPool() as pool``. PrestoRequest.__init__ is
+    synchronous, so lookups can't interleave on the event loop and no lock is
+    needed.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self._sessions = {}  # type: Dict[Tuple, Any]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def session(self, host, port, http_scheme, verify, transport=TRANSPORT_AIOHTTP):
+        # type: (Text, int, Text, bool, Text) -> Any
+        if transport == TRANSPORT_HTTPX:
+            key = (transport, verify)
+        else:
+            key = (host, port, http_scheme, verify)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            session = self._sessions[key] = _new_session(transport, verify)
+        return session
+
+    async def close(self):
+        # type: () -> None
+        """Close every pooled HTTP session."""
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+
+def _discard(task):
+    # type: (asyncio.Future) -> None
+    """Cancel an HTTP call nobody waits for, or release the response it already produced."""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        if task.exception() is None:
+            task.result().release()
+
+
 class PrestoRequest(object):
     """
     Manage the HTTP requests of a Presto presto.
@@ -106,6 +263,13 @@ class PrestoRequest(object):
     :request_timeout: How long (in seconds) to wait for the server to send
                       data before giving up, as a float or a
                       ``(connect timeout, read timeout)`` tuple.
+    :transport: ``"aiohttp"`` (default) or ``"httpx"``. The httpx transport
+                polls over HTTP/2 on one shared ``httpx.AsyncClient`` and
+                requires ``httpx[http2]``; it does not support ``auth``.
+    :session_pool: :class:`PrestoSessionPool` to take the HTTP session from
+                   when neither ``http_session`` nor authentication is
+                   given. The pool owns that session, so :meth:`close`
+                   leaves it open.
 
     The client initiates a presto by sending an HTTP POST to the
     coordinator. It then gets a response back from the coordinator with:
@@ -160,7 +324,9 @@ class PrestoRequest(object):
             request_timeout=constants.DEFAULT_REQUEST_TIMEOUT,  # type: Union[float, Tuple[float, float]]
             handle_retry=exceptions.RetryWithExponentialBackoff(),
             service_account_file=None,
-            verify=False  # type: bool
+            verify=False,  # type: bool
+            transport=TRANSPORT_AIOHTTP,  # type: Text
+            session_pool=None,  # type: Optional[PrestoSessionPool]
     ):
         # type: (...) -> None
         self._client_session = ClientSession(
@@ -172,17 +338,37 @@ class PrestoRequest(object):
             http_headers,
             transaction_id,
         )
+        # custom http headers are fixed at construction, so the reserved-name check runs once
+        reserved = _RESERVED_HEADERS.intersection(self._client_session.headers)
+        if reserved:
+            raise ValueError("cannot override reserved HTTP header {}".format(", ".join(sorted(reserved))))
 
         self._host = host
         self._port = port
         self._next_uri = next_uri  # type: Optional[Text]
+        self._http_headers = None  # type: Optional[List[Tuple[Text, Text]]]
+        self._last_session_headers = (None, None)  # type: Tuple[Optional[Text], Optional[Text]]
+        self._inflight = {}  # type: Dict[Text, List[Any]]
 
+        # reject the configuration before a client (and its connector) is created for it
+        if auth:
+            if http_scheme == constants.HTTP:
+                raise ValueError("cannot use authentication with HTTP")
+            if transport == TRANSPORT_HTTPX:
+                raise ValueError("authentication is only supported with the aiohttp transport")
+
+        # authenticated sessions carry per-user state, so only anonymous ones are shared
+        pooled = (
+            session_pool is not None and http_session is None and not auth and service_account_file is None
+        )
         if http_session is not None:
             self._http_session = http_session
             self._close_session = False
+        elif pooled:
+            self._http_session = session_pool.session(host, port, http_scheme, verify, transport)
+            self._close_session = False
         else:
-            # mypy cannot follow module import
-            self._http_session = self.http.ClientSession(connector=PrestoTCPConnector(verify_ssl=verify))  # type: ignore
+            self._http_session = _new_session(transport, verify)
             self._close_session = True
         self.credentials = None
         self.auth_req = None
@@ -194,16 +380,19 @@ class PrestoRequest(object):
             self.credentials = service_account.Credentials.from_service_account_file(
                 service_account_file, scopes=[constants.GCS_READ_ONLY]
             )
-            self._http_session.headers.update(self.get_oauth_token())
+        # the first token is fetched lazily by refresh_oauth_token() before the first request
+        self._token_exp = 0.0
 
-        self._http_session.headers.update(self.http_headers)
+        if not pooled:
+            # pooled sessions are shared across users and catalogs; every call passes http_headers instead
+            self._http_session.headers.update(self.http_headers)
         self._exceptions = self.HTTP_EXCEPTIONS
+        if transport == TRANSPORT_HTTPX:
+            self._exceptions += self._http_session.exceptions
         self._auth = auth
         if self._auth:
-            if http_scheme == constants.HTTP:
-                raise ValueError("cannot use authentication with HTTP")
             self._auth.set_http_session(self._http_session)
-            self._exceptions += self._auth.get_exceptions()
+            self._exceptions += _auth_exceptions(self._auth)
 
         self._redirect_handler = redirect_handler
         self._request_timeout = request_timeout
@@ -211,6 +400,8 @@ class PrestoRequest(object):
         self.max_attempts = max_attempts
         self._http_scheme = http_scheme
         self._verify = verify
+        self._base_url = f"{http_scheme}://{host}:{port}"
+        self._statement_url = self._base_url + constants.URL_STATEMENT_PATH
 
     async def __aenter__(self):
         return self
@@ -221,7 +412,7 @@ class PrestoRequest(object):
     async def _close_http_session(self):
         if self._http_session and self._close_session:
             if not self._http_session.closed:
-                await self._http_session.connector.close()
+                await self._http_session.close()
             self._http_session = None
 
     async def close(self):
@@ -234,34 +425,44 @@ class PrestoRequest(object):
     @transaction_id.setter
     def transaction_id(self, value):
         self._client_session.transaction_id = value
+        self._http_headers = None
 
     @property
     def http_headers(self):
-        # type: () -> Dict[Text, Text]
-        header_session = ",".join(
+        # type: () -> List[Tuple[Text, Text]]
+        # rebuilt only after the session properties or the transaction change
+        if self._http_headers is not None:
+            return self._http_headers
+
+        client_session = self._client_session
+        header_session = ",".join([
             # ``name`` must not contain ``=``
-            "{}={}".format(name, parse.quote(str(value)))
-            for name, value in self._client_session.properties.items()
+            name + "=" + quote_from_bytes(str(value).encode("utf-8"), safe="/")
+            for name, value in client_session.properties.items()
+        ])
+
+        headers = []
+        if client_session.catalog is not None:
+            headers.append((constants.HEADER_CATALOG, client_session.catalog))
+        if client_session.schema is not None:
+            headers.append((constants.HEADER_SCHEMA, client_session.schema))
+        if client_session.source is not None:
+            headers.append((constants.HEADER_SOURCE, client_session.source))
+        if client_session.user is not None:
+            headers.append((constants.HEADER_USER, client_session.user))
+        headers.append((constants.HEADER_SESSION, header_session))
+
+        # merge custom http headers, reserved ones were rejected in __init__
+        headers.extend(
+            (key, value) for key, value in client_session.headers.items()
+            if value is not None and key != constants.HEADER_TRANSACTION
         )
 
-        headers = {
-            constants.HEADER_CATALOG: self._client_session.catalog,
-            constants.HEADER_SCHEMA: self._client_session.schema,
-            constants.HEADER_SOURCE: self._client_session.source,
-            constants.HEADER_USER: self._client_session.user,
-            constants.HEADER_SESSION: header_session
-        }
-
-        # merge custom http headers
-        for key in self._client_session.headers:
-            if key in headers.keys():
-                raise ValueError("cannot override reserved HTTP header {}".format(key))
-        headers.update(self._client_session.headers)
+        if client_session.transaction_id is not None:
+            headers.append((constants.HEADER_TRANSACTION, client_session.transaction_id))
 
-        transaction_id = self._client_session.transaction_id
-        headers[constants.HEADER_TRANSACTION] = transaction_id
-
-        return {k: v for k, v in headers.items() if v is not None}
+        self._http_headers = headers
+        return self._http_headers
 
     @property
     def max_attempts(self):
@@ -272,41 +473,45 @@ class PrestoRequest(object):
     def max_attempts(self, value):
         # type: (int) -> None
         self._max_attempts = value
+        post_redirect = functools.partial(self._http_session.post, allow_redirects=False)
         if value == 1:  # No retry
+            self._retry = None
             self._get = self._http_session.get
             self._post = self._http_session.post
+            self._post_redirect = post_redirect
             self._delete = self._http_session.delete
             return
 
-        with_retry = exceptions.retry_with(
-            self._handle_retry,
-            exceptions=self._exceptions,
-            conditions=(
-                # need retry when there is no exception but the status code is 503
-                lambda response: getattr(response, "status", None) == 503,
-            ),
-            max_attempts=self._max_attempts,
-        )
-        self._get = with_retry(self._http_session.get)
-        self._post = with_retry(self._http_session.post)
-        self._delete = with_retry(self._http_session.delete)
+        self._retry = _retry_decorator(self._handle_retry, self._exceptions, self._max_attempts)
+        self._get = self._retry(self._http_session.get)
+        self._post = self._retry(self._http_session.post)
+        # redirect hops go through the same retry policy as the first POST
+        self._post_redirect = self._retry(post_redirect)
+        self._delete = self._retry(self._http_session.delete)
 
     def get_url(self, path):
         # type: (Text) -> Text
-        return f"{self._http_scheme}://{self._host}:{self._port}{path}"
+        return self._base_url + path
 
     @property
     def statement_url(self):
         # type: () -> Text
-        return self.get_url(constants.URL_STATEMENT_PATH)
+        return self._statement_url
 
     @property
     def next_uri(self):
         # type: () -> Text
         return self._next_uri
 
+    @next_uri.setter
+    def next_uri(self, value):
+        # type: (Optional[Text]) -> None
+        self._next_uri = value
+
     async def post(self, sql):
-        data = sql.encode("utf-8")
+        # type: (Union[Text, bytes, bytearray]) -> Any
+        # already-encoded SQL is sent as is; both transports send bytes bodies without another copy
+        data = sql if isinstance(sql, (bytes, bytearray)) else sql.encode()
         http_headers = self.http_headers
 
         http_response = await self._post(
@@ -322,36 +527,49 @@ class PrestoRequest(object):
             while http_response is not None and is_redirect(http_response):
                 location = http_response.headers["Location"]
                 url = self._redirect_handler.handle(location)
-                logger.info(f"redirect {http_response.status} from {location} to {url}")
-                http_response = self._post(
+                logger.info("redirect %s from %s to %s", http_response.status, location, url)
+                http_response = await self._post_redirect(
                     url,
                     data=data,
                     headers=http_headers,
                     timeout=self._request_timeout,
-                    allow_redirects=False,
                     proxy=PROXIES,
                 )
         return http_response
 
     async def get(self, url):
-        return await self._get(
-            url,
-            headers=self.http_headers,
-            timeout=self._request_timeout,
-            proxy=PROXIES,
-        )
+        # Presto invalidates a next_uri once it is fetched, so concurrent GETs of the same URL
+        # share one HTTP call instead of issuing a duplicate. Each entry is [task, waiters].
+        entry = self._inflight.get(url)
+        if entry is None:
+            task = asyncio.ensure_future(self._get(
+                url,
+                headers=self.http_headers,
+                timeout=self._request_timeout,
+                proxy=PROXIES,
+            ))
+            entry = self._inflight[url] = [task, 0]
+        task = entry[0]
+        entry[1] += 1
+        try:
+            # shielded so a cancelled caller doesn't cancel the call for the others sharing it
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1:
+                # the last waiter is leaving, nobody will read the response
+                _discard(task)
+            raise
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._inflight.get(url) is entry:
+                del self._inflight[url]
 
     async def delete(self, url):
-        return await self._delete(url, timeout=self._request_timeout, proxy=PROXIES)
+        return await self._delete(url, headers=self.http_headers, timeout=self._request_timeout, proxy=PROXIES)
 
     def _process_error(self, error, query_id):
-        error_type = error["errorType"]
-        if error_type == "EXTERNAL":
-            raise exceptions.PrestoExternalError(error, query_id)
-        elif error_type == "USER_ERROR":
-            return exceptions.PrestoUserError(error, query_id)
-
-        return exceptions.PrestoQueryError(error, query_id)
+        error_class = _ERROR_CLASSES.get(error["errorType"], exceptions.PrestoQueryError)
+        return error_class(error, query_id)
 
     def raise_response_error(self, http_response):
         # type: (aiohttp.ClientResponse) -> None
@@ -370,23 +588,29 @@ class PrestoRequest(object):
         if not http_response.ok:
             self.raise_response_error(http_response)
 
-        http_response.encoding = "utf-8"
-        response = await http_response.json()
-        logger.debug(f"HTTP {http_response.status}: {response}")
+        # Presto always answers in utf-8, so aiohttp's charset detection is skipped
+        response = _json_loads(await http_response.read())
+        logger.debug("HTTP %s: %s", http_response.status, response)
         if "error" in response:
             raise self._process_error(response["error"], response.get("id"))
 
-        if constants.HEADER_CLEAR_SESSION in http_response.headers:
-            for prop in get_header_values(
-                    http_response.headers, constants.HEADER_CLEAR_SESSION
-            ):
-                self._client_session.properties.pop(prop, None)
+        # Presto usually sends these on a single page; applying the same pair twice in a row
+        # changes nothing, so repeated headers are skipped without being parsed again
+        clear_session = http_response.headers.get(constants.HEADER_CLEAR_SESSION)
+        set_session = http_response.headers.get(constants.HEADER_SET_SESSION)
+        session_headers = (clear_session, set_session)
+        if session_headers != self._last_session_headers:
+            self._last_session_headers = session_headers
+
+            if clear_session is not None:
+                for prop in get_header_values(http_response.headers, constants.HEADER_CLEAR_SESSION):
+                    self._client_session.properties.pop(prop, None)
+                self._http_headers = None
 
-        if constants.HEADER_SET_SESSION in http_response.headers:
-            for key, value in get_session_property_values(
-                    http_response.headers, constants.HEADER_SET_SESSION
-            ):
-                self._client_session.properties[key] = value
+            if set_session is not None:
+                for key, value in get_session_property_values(http_response.headers, constants.HEADER_SET_SESSION):
+                    self._client_session.properties[key] = value
+                self._http_headers = None
 
         self._next_uri = response.get("nextUri")
 
@@ -404,8 +628,32 @@ class PrestoRequest(object):
     def http_session(self):
         return self._http_session
 
-    def get_oauth_token(self):
-        self.credentials.refresh(self.auth_req)
+    @property
+    def host(self):
+        # type: () -> Text
+        return self._host
+
+    @property
+    def port(self):
+        # type: () -> int
+        return self._port
+
+    @property
+    def client_session(self):
+        # type: () -> ClientSession
+        return self._client_session
+
+    async def get_oauth_token(self):
+        # credentials.refresh() is a blocking HTTP call, so it runs in the default executor,
+        # and only when the cached token is within a minute of expiring
+        if time.time() > self._token_exp - 60:
+            await asyncio.get_running_loop().run_in_executor(None, self.credentials.refresh, self.auth_req)
+            expiry = self.credentials.expiry
+            self._token_exp = expiry.replace(tzinfo=timezone.utc).timestamp() if expiry else float("inf")
         return {
             constants.PRESTO_EXTRA_CREDENTIAL: f"{constants.GCS_CREDENTIALS_OAUTH_TOKEN_KEY} = {self.credentials.token}"
         }
+
+    async def refresh_oauth_token(self):
+        if self.credentials is not None:
+            self._http_session.headers.update(await self.get_oauth_token())
@@ -1,3 +1,6 @@
+import asyncio
+
+
 class PrestoResult(object):
     """
     Represent the result of a Trino query as an iterator on rows.
@@ -13,22 +16,37 @@ class PrestoResult(object):
     @property
     def rownumber(self):
         # type: () -> int
+        # updated once per page while iterating
         return self._rownumber
 
     def __aiter__(self):
         # Easier then manually implementing __anext__
         async def gen():
-            # Initial fetch from the first POST request
-            for row in self._rows:
-                self._rownumber += 1
-                yield row
-            self._rows = None
-            # Subsequent fetches from GET requests until next_uri is empty.
-            while not self._query.is_finished():
-                rows = await self._query.fetch()
-                for row in rows:
-                    self._rownumber += 1
+            # The next page is requested before the current one is handed out, so
+            # the HTTP round trip overlaps with the caller consuming rows.
+            pending = None
+            n = self._rownumber
+            try:
+                if not self._query.is_finished():
+                    pending = asyncio.create_task(self._query.fetch())
+                # Initial fetch from the first POST request
+                for n, row in enumerate(self._rows, n + 1):
                     yield row
+                self._rownumber = n
+                self._rows = None
+                # Subsequent fetches from GET requests until next_uri is empty.
+                while pending is not None:
+                    rows = await pending
+                    pending = None
+                    if not self._query.is_finished():
+                        pending = asyncio.create_task(self._query.fetch())
+                    for n, row in enumerate(rows, n + 1):
+                        yield row
+                    self._rownumber = n
+            finally:
+                self._rownumber = n
+                if pending is not None:
+                    pending.cancel()
 
         return gen()
 
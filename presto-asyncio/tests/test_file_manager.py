@@ -0,0 +1,93 @@
+import asyncio
+import math
+import os
+import tempfile
+import unittest
+from unittest import mock
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+
+import file_manager
+
+# one value for every python type the file row converters in main produce, with what it reads
+# back as; doubles and times with a time zone arrive as strings, map keys as strings
+CONVERTED_VALUES = [
+    (Decimal("12.340"), "12.340"),
+    (1.5, 1.5),
+    ("Infinity", "Infinity"),
+    (date(2020, 1, 2), "2020-01-02"),
+    (datetime(2020, 1, 2, 3, 4, 5), "2020-01-02T03:04:05"),
+    (datetime(2020, 1, 2, 3, 4, 5, 123000), "2020-01-02T03:04:05.123000"),
+    (datetime(2020, 1, 2, 3, 4, 5, 123000, tzinfo=ZoneInfo("UTC")), "2020-01-02T03:04:05.123000+00:00"),
+    (datetime(2020, 7, 2, 3, 4, 5, tzinfo=ZoneInfo("America/New_York")), "2020-07-02T03:04:05-04:00"),
+    (datetime(2020, 1, 2, 3, 4, 5, 123000, tzinfo=timezone(timedelta(hours=5))), "2020-01-02T03:04:05.123000+05:00"),
+    (time(1, 2, 3, 456000), "01:02:03.456000"),
+    ([date(2020, 1, 1), None], ["2020-01-01", None]),
+    ((date(2020, 1, 1), 3), ["2020-01-01", 3]),
+    ({"2020-01-01": Decimal("1.5"), "2": True}, {"2020-01-01": "1.5", "2": True}),
+    ("\u00e9", "\u00e9"),
+    (None, None),
+]
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._dir = tempfile.TemporaryDirectory()
+        os.chdir(self._dir.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._dir.cleanup()
+
+    def test_converted_types_round_trip(self):
+        rows = [[value] for value, _ in CONVERTED_VALUES]
+
+        async def save():
+            await file_manager.save_columns([{'name': 'v', 'type': 'varchar'}], 'q')
+            await file_manager.save_rows(rows, 'q')
+
+        asyncio.run(save())
+        read = [row[0] for row in file_manager.read_rows('q.json')]
+        self.assertEqual(read, [expected for _, expected in CONVERTED_VALUES])
+
+    def test_non_finite_floats_are_rejected(self):
+        # orjson would write them as null, so the converters never hand them over
+        with self.assertRaises(ValueError):
+            file_manager._dumps_json([math.nan])
+
+    @unittest.skipIf(file_manager.orjson is None, "orjson is not installed")
+    def test_orjson_and_json_write_the_same_bytes(self):
+        for value, _ in CONVERTED_VALUES:
+            with self.subTest(value=value):
+                self.assertEqual(file_manager._dumps_orjson([value]), file_manager._dumps_json([value]))
+
+
+@unittest.skipUnless(hasattr(os, 'writev'), "os.writev is not available")
+class WriteBatchesTest(unittest.TestCase):
+
+    def test_short_writes(self):
+        batches = [bytes([65 + i % 26]) * (i % 5) for i in range(40)]
+        real_writev = os.writev
+        submitted = []
+        counts = iter(range(1, 1000))
+
+        def short_writev(fd, buffers):
+            # write only part of what is submitted, often stopping inside a buffer
+            submitted.append(len(buffers))
+            return real_writev(fd, [b''.join(buffers)[:next(counts) % 7]])
+
+        with tempfile.TemporaryFile() as fp:
+            # still in the file object's buffer, so it has to be flushed ahead of the batches
+            fp.write(b'header\n')
+            with mock.patch.object(file_manager, 'IOV_MAX', 3), mock.patch.object(os, 'writev', short_writev):
+                file_manager.write_batches(fp, batches)
+            fp.seek(0)
+            self.assertEqual(fp.read(), b'header\n' + b''.join(batches))
+        self.assertLessEqual(max(submitted), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import asyncio
+import math
+import unittest
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+
+from main import _convert_rows, _make_row_converters, execute_presto, map_to_python_type
+from presto.presto_request import PrestoRequest
+from query_context import QueryContext
+
+
+def sig(raw_type, *arguments):
+    return {'rawType': raw_type, 'arguments': list(arguments)}
+
+
+def type_arg(signature):
+    return {'kind': 'TYPE', 'value': signature}
+
+
+def field_arg(name, signature):
+    return {'kind': 'NAMED_TYPE', 'value': {'fieldName': {'name': name}, 'typeSignature': signature}}
+
+
+def column(signature):
+    return {'typeSignature': signature}
+
+
+DECIMAL = sig('decimal', {'kind': 'LONG', 'value': 5}, {'kind': 'LONG', 'value': 3})
+DOUBLE = sig('double')
+DATE = sig('date')
+TIMESTAMP = sig('timestamp')
+TIMESTAMP_TZ = sig('timestamp with time zone')
+TIME = sig('time')
+TIME_TZ = sig('time with time zone')
+VARCHAR = sig('varchar', {'kind': 'LONG', 'value': 2147483647})
+BIGINT = sig('bigint')
+
+UTC_PLUS_5 = timezone(timedelta(hours=5))
+
+# (type signature, value Presto sends, python value)
+PYTHON_VALUES = [
+    (DECIMAL, '12.340', Decimal('12.340')),
+    (DOUBLE, 1.5, 1.5),
+    (DOUBLE, 'Infinity', float('inf')),
+    (DOUBLE, '-Infinity', float('-inf')),
+    (DATE, '2020-01-02', date(2020, 1, 2)),
+    (TIMESTAMP, '2020-01-02 03:04:05.123', datetime(2020, 1, 2, 3, 4, 5, 123000)),
+    (TIMESTAMP, '2020-01-02 03:04:05.123456', datetime(2020, 1, 2, 3, 4, 5, 123456)),
+    (TIMESTAMP_TZ, '2020-01-02 03:04:05.123 +05:00', datetime(2020, 1, 2, 3, 4, 5, 123000, tzinfo=UTC_PLUS_5)),
+    (TIMESTAMP_TZ, '2020-07-02 03:04:05.123 America/New_York',
+     datetime(2020, 7, 2, 3, 4, 5, 123000, tzinfo=ZoneInfo('America/New_York'))),
+    (TIME, '01:02:03.456', time(1, 2, 3, 456000)),
+    (TIME_TZ, '01:02:03.456+05:30', time(1, 2, 3, 456000, tzinfo=timezone(timedelta(hours=5, minutes=30)))),
+    (TIME_TZ, '01:02:03.456-05:30', time(1, 2, 3, 456000, tzinfo=timezone(-timedelta(hours=5, minutes=30)))),
+    (sig('array', type_arg(DATE)), ['2020-01-01', None], [date(2020, 1, 1), None]),
+    (sig('map', type_arg(VARCHAR), type_arg(DECIMAL)), {'a': '1.5', 'b': None}, {'a': Decimal('1.5'), 'b': None}),
+    (sig('map', type_arg(DATE), type_arg(BIGINT)), {'2020-01-01': 1}, {date(2020, 1, 1): 1}),
+    (sig('row', field_arg('x', BIGINT), field_arg('d', DATE)), [1, '2020-01-01'], (1, date(2020, 1, 1))),
+    (VARCHAR, 'text', 'text'),
+    (BIGINT, 7, 7),
+]
+
+TYPED_SIGNATURES = [DECIMAL, DOUBLE, DATE, TIMESTAMP, TIMESTAMP_TZ, TIME, TIME_TZ, sig('array', type_arg(DATE)),
+                    sig('map', type_arg(VARCHAR), type_arg(DATE)), sig('row', field_arg('d', DATE))]
+
+
+class MapToPythonTypeTest(unittest.TestCase):
+
+    def test_values(self):
+        for signature, value, expected in PYTHON_VALUES:
+            with self.subTest(raw_type=signature['rawType'], value=value):
+                converted = map_to_python_type((value, column(signature)))
+                self.assertEqual(converted, expected)
+                self.assertIs(type(converted), type(expected))
+
+    def test_named_zone_uses_the_current_offset(self):
+        # pytz without localize() gave the zone's LMT offset (-4:56 for New York)
+        converted = map_to_python_type(('2020-07-02 03:04:05.123 America/New_York', column(TIMESTAMP_TZ)))
+        self.assertEqual(converted.utcoffset(), -timedelta(hours=4))
+
+    def test_nan(self):
+        self.assertTrue(math.isnan(map_to_python_type(('NaN', column(DOUBLE)))))
+
+    def test_null(self):
+        for signature in TYPED_SIGNATURES:
+            with self.subTest(raw_type=signature['rawType']):
+                self.assertIsNone(map_to_python_type((None, column(signature))))
+
+    def test_bad_value(self):
+        with self.assertRaisesRegex(TypeError, "Could not convert 'bad' into the associated python type for 'date'"):
+            map_to_python_type(('bad', column(DATE)))
+
+    def test_sub_microsecond_precision_is_rejected(self):
+        # datetime can't hold it; failing beats truncating silently, whatever the python version
+        values = [
+            (TIMESTAMP, '2020-01-02 03:04:05.123456789'),
+            (TIMESTAMP_TZ, '2020-01-02 03:04:05.1234567 +05:00'),
+            (TIMESTAMP_TZ, '2020-01-02 03:04:05.1234567 America/New_York'),
+            (TIME, '01:02:03.123456789'),
+            (TIME_TZ, '01:02:03.123456789+05:30'),
+        ]
+        for signature, value in values:
+            with self.subTest(value=value):
+                with self.assertRaises(TypeError):
+                    map_to_python_type((value, column(signature)))
+
+    def test_bad_item(self):
+        with self.assertRaises(TypeError):
+            map_to_python_type((['2020-01-01', 'bad'], column(sig('array', type_arg(DATE)))))
+
+
+class RowConvertersTest(unittest.TestCase):
+
+    def _convert(self, signatures, row):
+        columns = [column(signature) for signature in signatures]
+        return _convert_rows([row], _make_row_converters(columns))[0]
+
+    def test_only_typed_columns_are_converted(self):
+        converters = _make_row_converters([column(BIGINT), column(DATE), column(VARCHAR), column(DOUBLE)])
+        self.assertEqual([index for index, _ in converters], [1])
+
+    def test_file_values(self):
+        row = self._convert(
+            [DECIMAL, DOUBLE, DATE, TIMESTAMP_TZ, TIME_TZ, sig('map', type_arg(DATE), type_arg(DATE))],
+            ['12.340', 'NaN', '2020-01-02', '2020-01-02 03:04:05.123 +05:00', '01:02:03.456+05:30',
+             {'2020-01-01': '2020-01-02'}],
+        )
+        self.assertEqual(row, [
+            Decimal('12.340'),
+            'NaN',
+            date(2020, 1, 2),
+            datetime(2020, 1, 2, 3, 4, 5, 123000, tzinfo=UTC_PLUS_5),
+            '01:02:03.456000+05:30',
+            {'2020-01-01': date(2020, 1, 2)},
+        ])
+
+    def test_pass_through_containers(self):
+        value = [1.5, 'Infinity']
+        row = self._convert([sig('array', type_arg(DOUBLE)), BIGINT], [value, 1])
+        self.assertIs(row[0], value)
+
+    def test_null(self):
+        row = self._convert(TYPED_SIGNATURES, [None] * len(TYPED_SIGNATURES))
+        self.assertEqual(row, [None] * len(TYPED_SIGNATURES))
+
+
+
+class UnusedSession(object):
+
+    closed = False
+
+    def __init__(self):
+        self.headers = {}
+
+    async def post(self, *args, **kwargs):
+        raise AssertionError("no request should be sent")
+
+    get = delete = post
+
+
+class CallerOwnedRequestTest(unittest.TestCase):
+
+    def test_mismatched_context_is_rejected(self):
+        request = PrestoRequest(host='localhost', port=8080, user='user', catalog='x', schema='default',
+                                source='test', http_session=UnusedSession())
+        query_context = QueryContext(host='localhost', port=8080, user='user', catalog='y', schema='other',
+                                     source='test', query='select 1')
+        with self.assertRaisesRegex(ValueError, 'query context does not match the request: catalog, schema'):
+            asyncio.run(execute_presto(query_context, request))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+import asyncio
+import gc
+import json
+import os
+import tempfile
+import unittest
+import warnings
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from multidict import CIMultiDict
+from prestodb import constants
+from prestodb.client import get_header_values, get_session_property_values
+
+from main import execute_presto, execute_presto_batch
+from presto.presto_request import PrestoRequest, PrestoSessionPool
+from query_context import QueryContext
+
+COLUMNS = [{'name': 'a', 'type': 'bigint', 'typeSignature': {'rawType': 'bigint', 'arguments': []}}]
+
+
+async def _statement(request):
+    return web.json_response({
+        'id': 'q1',
+        'infoUri': 'http://localhost/ui/q1',
+        'stats': {},
+        'columns': COLUMNS,
+        'data': [[1], [2]],
+    })
+
+
+async def _serve(run):
+    app = web.Application()
+    app.router.add_post('/v1/statement', _statement)
+    server = TestServer(app, host='127.0.0.1')
+    await server.start_server()
+    try:
+        return await run(QueryContext(
+            host='127.0.0.1',
+            port=server.port,
+            user='user',
+            catalog='memory',
+            schema='default',
+            source='test',
+            query='select 1',
+        ))
+    finally:
+        await server.close()
+
+
+class SessionLifetimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._dir = tempfile.TemporaryDirectory()
+        os.chdir(self._dir.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._dir.cleanup()
+
+    def _assert_no_unclosed_sessions(self, run):
+        # two loops in a row, the way a script calling asyncio.run() per query would
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            for _ in range(2):
+                asyncio.run(_serve(run))
+            gc.collect()
+        self.assertEqual([str(w.message) for w in caught if issubclass(w.category, ResourceWarning)], [])
+        # sessions still referenced somewhere would only warn at interpreter exit
+        unclosed = [obj for obj in gc.get_objects() if isinstance(obj, aiohttp.ClientSession) and not obj.closed]
+        self.assertEqual(unclosed, [])
+
+    def test_execute_presto_closes_its_session(self):
+        self._assert_no_unclosed_sessions(execute_presto)
+
+    def test_execute_presto_batch_closes_its_pool(self):
+        async def run(query_context):
+            results = await execute_presto_batch([query_context, query_context])
+            self.assertEqual(results, [query_context, query_context])
+
+        self._assert_no_unclosed_sessions(run)
+
+    def test_caller_owned_request(self):
+        async def run(query_context):
+            request = PrestoRequest(
+                host=query_context.host,
+                port=query_context.port,
+                user=query_context.user,
+                catalog=query_context.catalog,
+                schema=query_context.schema,
+                source=query_context.source,
+            )
+            async with request:
+                self.assertIs(await execute_presto(query_context, request), query_context)
+                self.assertIs(await execute_presto(query_context, request), query_context)
+
+        self._assert_no_unclosed_sessions(run)
+
+    def test_pool_shares_and_closes_sessions(self):
+        async def run(query_context):
+            async with PrestoSessionPool() as pool:
+                first = await execute_presto(query_context, session_pool=pool)
+                second = await execute_presto(query_context, session_pool=pool)
+                self.assertEqual(len(pool._sessions), 1)
+                session = next(iter(pool._sessions.values()))
+            self.assertTrue(session.closed)
+            return first, second
+
+        self._assert_no_unclosed_sessions(run)
+
+
+
+class FakeResponse(object):
+
+    def __init__(self):
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class FakeSession(object):
+    """Holds every GET until ``finish`` is set, remembering the calls and cancellations."""
+
+    closed = False
+
+    def __init__(self):
+        self.headers = {}
+        self.calls = []
+        self.cancelled = []
+        self.finish = asyncio.Event()
+
+    async def get(self, url, **kwargs):
+        self.calls.append(url)
+        try:
+            await self.finish.wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(url)
+            raise
+        return FakeResponse()
+
+    post = delete = get
+
+
+class CoalescedGetTest(unittest.TestCase):
+
+    def _request(self, session):
+        return PrestoRequest(host='localhost', port=8080, user='user', http_session=session, max_attempts=1)
+
+    def test_concurrent_gets_share_one_call(self):
+        async def run():
+            session = FakeSession()
+            request = self._request(session)
+            first = asyncio.ensure_future(request.get('http://localhost/next'))
+            second = asyncio.ensure_future(request.get('http://localhost/next'))
+            await asyncio.sleep(0)
+            session.finish.set()
+            responses = await asyncio.gather(first, second)
+            self.assertEqual(session.calls, ['http://localhost/next'])
+            self.assertIs(responses[0], responses[1])
+            self.assertEqual(request._inflight, {})
+
+        asyncio.run(run())
+
+    def test_cancelling_the_only_waiter_cancels_the_call(self):
+        async def run():
+            session = FakeSession()
+            request = self._request(session)
+            waiter = asyncio.ensure_future(request.get('http://localhost/next'))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            await asyncio.sleep(0)
+            self.assertEqual(session.cancelled, ['http://localhost/next'])
+            self.assertEqual(request._inflight, {})
+
+        asyncio.run(run())
+
+    def test_cancelling_the_only_waiter_releases_a_finished_call(self):
+        async def run():
+            session = FakeSession()
+            session.finish.set()
+            request = self._request(session)
+            waiter = asyncio.ensure_future(request.get('http://localhost/next'))
+            # the call completes, but the waiter is cancelled before it sees the response
+            while not session.calls:
+                await asyncio.sleep(0)
+            task = request._inflight['http://localhost/next'][0]
+            task.add_done_callback(lambda _: waiter.cancel())
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            self.assertTrue(task.result().released)
+            self.assertEqual(request._inflight, {})
+
+        asyncio.run(run())
+
+    def test_cancelling_one_of_two_waiters_keeps_the_call(self):
+        async def run():
+            session = FakeSession()
+            request = self._request(session)
+            cancelled = asyncio.ensure_future(request.get('http://localhost/next'))
+            kept = asyncio.ensure_future(request.get('http://localhost/next'))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await cancelled
+            session.finish.set()
+            response = await kept
+            self.assertIsInstance(response, FakeResponse)
+            self.assertFalse(response.released)
+            self.assertEqual(session.calls, ['http://localhost/next'])
+            self.assertEqual(session.cancelled, [])
+            self.assertEqual(request._inflight, {})
+
+        asyncio.run(run())
+
+
+
+class FakePage(object):
+
+    ok = True
+    status = 200
+
+    def __init__(self, headers):
+        self.headers = CIMultiDict(headers)
+
+    async def read(self):
+        return json.dumps({'id': 'q1', 'infoUri': 'http://localhost/ui/q1', 'stats': {}}).encode()
+
+
+SET_SESSION_HEADERS = [
+    'a=1',
+    ' a = x%20y , b=2',
+    'a=b=c',
+    'a=%3D%2C',
+    "a='quoted value'",
+    'a="x%2Cy"',
+    'a=',
+]
+
+
+class SessionHeadersTest(unittest.TestCase):
+
+    def _process(self, request, headers):
+        asyncio.run(request.process(FakePage(headers)))
+
+    def _request(self, **properties):
+        return PrestoRequest(host='localhost', port=8080, user='user', http_session=FakeSession(),
+                             session_properties=properties)
+
+    def test_set_session_matches_prestodb(self):
+        for header in SET_SESSION_HEADERS:
+            with self.subTest(header=header):
+                request = self._request()
+                headers = {constants.HEADER_SET_SESSION: header}
+                self._process(request, headers)
+                expected = dict(get_session_property_values(CIMultiDict(headers), constants.HEADER_SET_SESSION))
+                self.assertEqual(request._client_session.properties, expected)
+
+    def test_malformed_set_session_fails_like_prestodb(self):
+        headers = {constants.HEADER_SET_SESSION: 'a=1,b'}
+        with self.assertRaises(ValueError):
+            get_session_property_values(CIMultiDict(headers), constants.HEADER_SET_SESSION)
+        with self.assertRaises(ValueError):
+            self._process(self._request(), headers)
+
+    def test_clear_session_matches_prestodb(self):
+        headers = {constants.HEADER_CLEAR_SESSION: ' a , c'}
+        request = self._request(a='1', b='2', c='3')
+        self._process(request, headers)
+        for prop in get_header_values(CIMultiDict(headers), constants.HEADER_CLEAR_SESSION):
+            self.assertNotIn(prop, request._client_session.properties)
+        self.assertEqual(request._client_session.properties, {'b': '2'})
+
+    def test_clear_and_set_in_one_page(self):
+        request = self._request(a='1', b='2')
+        self._process(request, {constants.HEADER_CLEAR_SESSION: 'a', constants.HEADER_SET_SESSION: 'c=3'})
+        self.assertEqual(request._client_session.properties, {'b': '2', 'c': '3'})
+        self.assertIn((constants.HEADER_SESSION, 'b=2,c=3'), request.http_headers)
+
+    def test_repeated_headers_are_skipped(self):
+        request = self._request()
+        headers = {constants.HEADER_SET_SESSION: 'a=1'}
+        self._process(request, headers)
+        http_headers = request.http_headers
+        self._process(request, headers)
+        # the cached headers survive, so the pair was not applied again
+        self.assertIs(request.http_headers, http_headers)
+        self._process(request, {constants.HEADER_SET_SESSION: 'a=2'})
+        self.assertEqual(request._client_session.properties, {'a': '2'})
+        self.assertIn((constants.HEADER_SESSION, 'a=2'), request.http_headers)
+
+
+if __name__ == '__main__':
+    unittest.main()